@@ -11,27 +11,51 @@ Options:
   -h --help     Show this screen.
   --bio  	Use BIO mode instead of BILOU
   --gold-column <g>  	The indice of the column containing the gold labels [default: -1]
+  --jobs <n>  	The number of processes to use, only worth it with several cores and large files [default: 1]
   --label-regex <r>  	A regular expression matching the labels [default: (?P<type>.*)_(?P<action>[BILOU])]
   --score <s>  	The scoring function, use `wasp list-score` to get a list [default: strict]
   --sys-column <s>  	The indice of the column containing the system labels [default: -2]
   --version     Show version.
 """
-import math
+
+from array import array
+import contextlib
+import functools
+import itertools
+import multiprocessing
 import pprint
 import re
-from typing import Callable, Collection, Iterable, List, NamedTuple, Optional, Tuple
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
 
 from docopt import docopt
 import numpy as np
 from scipy.optimize import linear_sum_assignment
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 from wasp import __version__
 
 
 class TypedSpan(NamedTuple):
     start: int
     end: int
-    type: Optional[str]
+    # The id of the label type, interned in `process_file`
+    type: int
 
 
 def exact_coef(a: TypedSpan, b: TypedSpan) -> float:
@@ -48,16 +72,143 @@ def dice_coef(a: TypedSpan, b: TypedSpan) -> float:
     )
 
 
+SpanArrays = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def span_arrays(spans: Collection[TypedSpan]) -> SpanArrays:
+    """Split spans into arrays of starts, ends and type ids."""
+    starts = np.fromiter(
+        (span.start for span in spans), dtype=np.int64, count=len(spans)
+    )
+    ends = np.fromiter((span.end for span in spans), dtype=np.int64, count=len(spans))
+    types = np.fromiter((span.type for span in spans), dtype=np.int64, count=len(spans))
+    return starts, ends, types
+
+
+def dice_coef_arrays(gold: SpanArrays, syst: SpanArrays) -> np.ndarray:
+    """`dice_coef` for spans given as broadcastable arrays."""
+    g_s, g_e, g_t = gold
+    s_s, s_e, s_t = syst
+    inter = np.maximum(np.minimum(g_e, s_e) - np.maximum(g_s, s_s), 0)
+    return np.where(g_t == s_t, 2 * inter / (g_e - g_s + s_e - s_s), 0.0)
+
+
+# Vectorized versions of the builtin scores, other scores are computed pair by pair
+SCORE_ARRAYS: Dict[
+    Callable[[TypedSpan, TypedSpan], float],
+    Callable[[SpanArrays, SpanArrays], np.ndarray],
+] = {
+    dice_coef: dice_coef_arrays,
+}
+# Solving the alignment separately for each group of overlapping spans only pays off above
+# this many (gold, syst) pairs, below it a single dense solve is faster
+GROUPED_ALIGNMENT_MIN_SIZE = 20000
+
+
+def score_matrix(
+    score_arrays: Callable[[SpanArrays, SpanArrays], np.ndarray],
+    gold: SpanArrays,
+    syst: SpanArrays,
+) -> np.ndarray:
+    """Apply a vectorized score to every (syst, gold) pair."""
+    return score_arrays(
+        (gold[0][None, :], gold[1][None, :], gold[2][None, :]),
+        (syst[0][:, None], syst[1][:, None], syst[2][:, None]),
+    )
+
+
+def best_alignment_score(scores: np.ndarray) -> float:
+    row_ind, col_ind = linear_sum_assignment(scores, maximize=True)
+    return scores[row_ind, col_ind].sum()
+
+
+def grouped_alignment_score(
+    gold: SpanArrays,
+    syst: SpanArrays,
+    score_arrays: Callable[[SpanArrays, SpanArrays], np.ndarray],
+) -> float:
+    """Best alignment score for a score that is 0 for spans that don't overlap or have
+    different types, solved separately for each group of transitively overlapping spans of
+    the same type.
+
+    Groups of exactly one gold and one system span, the most common, are scored together
+    without going through the solver.
+    """
+    n_gold = gold[0].size
+    starts, ends, types = (np.concatenate(arrays) for arrays in zip(gold, syst))
+    # Give each type its own range of offsets so that a single sweep handles all of them
+    offsets = types * (ends.max(initial=0) + 1)
+    order = np.argsort(starts + offsets, kind="stable")
+    sorted_starts = (starts + offsets)[order]
+    reach = np.maximum.accumulate((ends + offsets)[order])
+    new_group = np.ones(order.size, dtype=bool)
+    new_group[1:] = sorted_starts[1:] >= reach[:-1]
+    group_ids = np.cumsum(new_group) - 1
+    is_gold = order < n_gold
+    n_groups = int(group_ids[-1]) + 1 if order.size else 0
+    gold_counts = np.bincount(group_ids[is_gold], minlength=n_groups)
+    syst_counts = np.bincount(group_ids[~is_gold], minlength=n_groups)
+
+    is_pair = (gold_counts == 1) & (syst_counts == 1)
+    in_pair = is_pair[group_ids]
+    gold_idx = order[in_pair & is_gold]
+    syst_idx = order[in_pair & ~is_gold] - n_gold
+    total_score = score_arrays(
+        (gold[0][gold_idx], gold[1][gold_idx], gold[2][gold_idx]),
+        (syst[0][syst_idx], syst[1][syst_idx], syst[2][syst_idx]),
+    ).sum()
+
+    bounds = np.append(np.flatnonzero(new_group), order.size)
+    larger_groups = np.flatnonzero(~is_pair & (gold_counts > 0) & (syst_counts > 0))
+    for group in larger_groups.tolist():
+        members = order[bounds[group] : bounds[group + 1]]
+        gold_idx = members[members < n_gold]
+        syst_idx = members[members >= n_gold] - n_gold
+        total_score += best_alignment_score(
+            score_matrix(
+                score_arrays,
+                (gold[0][gold_idx], gold[1][gold_idx], gold[2][gold_idx]),
+                (syst[0][syst_idx], syst[1][syst_idx], syst[2][syst_idx]),
+            )
+        )
+    return total_score
+
+
 def aligned_score(
     gold: Collection[TypedSpan],
     syst: Collection[TypedSpan],
     score: Callable[[TypedSpan, TypedSpan], float],
 ) -> Tuple[float, float, float]:
-    cost_matrix = np.array([[-score(g, s) for g in gold] for s in syst])
-    row_ind, col_ind = linear_sum_assignment(cost_matrix)
-    total_score = -cost_matrix[row_ind, col_ind].sum()
-    pos = math.fsum(score(s, s) for s in syst)
-    tru = math.fsum(score(g, g) for g in gold)
+    # Only equal spans score, so the best alignment is the intersection
+    if score is exact_coef:
+        return (
+            float(len(set(gold).intersection(syst))),
+            float(len(syst)),
+            float(len(gold)),
+        )
+    score_arrays = SCORE_ARRAYS.get(score)
+    if score_arrays is not None:
+        gold_arrays = span_arrays(gold)
+        syst_arrays = span_arrays(syst)
+        if len(gold) * len(syst) >= GROUPED_ALIGNMENT_MIN_SIZE:
+            total_score = grouped_alignment_score(
+                gold_arrays, syst_arrays, score_arrays
+            )
+        else:
+            total_score = best_alignment_score(
+                score_matrix(score_arrays, gold_arrays, syst_arrays)
+            )
+    else:
+        total_score = best_alignment_score(
+            np.array([[score(g, s) for g in gold] for s in syst])
+        )
+    # The builtin scores are 1 for a span against itself
+    if score is exact_coef or score is dice_coef:
+        pos = float(len(syst))
+        tru = float(len(gold))
+    else:
+        pos = sum(score(s, s) for s in syst)
+        tru = sum(score(g, g) for g in gold)
     return total_score, pos, tru
 
 
@@ -67,46 +218,53 @@ SCORES = {
 }
 
 
-def spans_from_labels(labels: Iterable[Tuple[str, Optional[str]]], bilou: bool):
-    """Extract a list of typed spans from labels."""
+ACTION_CODES = {"B": 0, "I": 1, "L": 2, "O": 3, "U": 4}
+# The label actions, indexed by code
+ACTION_NAMES = "BILOU"
+
+
+def spans_from_labels(actions: Sequence[int], types: Sequence[int], bilou: bool):
+    """Extract a list of typed spans from `ACTION_CODES`-encoded label actions and label
+    types."""
     spans: List[TypedSpan] = []
     current_start = None
     current_type = None
-    for i, (label_action, label_type) in enumerate(labels):
-        if label_action == "B":
+    for i, (label_action, label_type) in enumerate(zip(actions, types)):
+        # Ordered by decreasing expected frequency: I, O, B, L, U
+        if label_action == 1:
+            if current_start is None:
+                raise ValueError(f"Invalid label action at {i}: I")
+            if label_type != current_type:
+                raise ValueError(f"Incoherent label type at {i}: I")
+        elif label_action == 3:
             if current_start is not None:
                 if bilou:
-                    raise ValueError(f"Invalid label at {i}: {label_action}")
+                    raise ValueError(f"Invalid label at {i}: O")
+                spans.append(TypedSpan(current_start, i, current_type))
+                current_start = None
+                current_type = None
+        elif label_action == 0:
+            if current_start is not None:
+                if bilou:
+                    raise ValueError(f"Invalid label at {i}: B")
                 spans.append(TypedSpan(current_start, i, current_type))
             current_start = i
             current_type = label_type
-        elif label_action == "I":
-            if current_start is None:
-                raise ValueError(f"Invalid label action at {i}: {label_action}")
-            if label_type != current_type:
-                raise ValueError(f"Incoherent label type at {i}: {label_type}")
-        elif label_action == "L":
+        elif label_action == 2:
             if not bilou:
                 raise ValueError('Label "L" invalid in BIO mode')
             if current_start is None:
-                raise ValueError(f"Invalid label at {i}: {label_action}")
+                raise ValueError(f"Invalid label at {i}: L")
             if label_type != current_type:
-                raise ValueError(f"Incoherent label type at {i}: {label_action}")
+                raise ValueError(f"Incoherent label type at {i}: L")
             spans.append(TypedSpan(current_start, i + 1, current_type))
             current_start = None
             current_type = None
-        elif label_action == "O":
-            if current_start is not None:
-                if bilou:
-                    raise ValueError(f"Invalid label at {i}: {label_action}")
-                spans.append(TypedSpan(current_start, i, current_type))
-                current_start = None
-                current_type = None
-        elif label_action == "U":
+        elif label_action == 4:
             if not bilou:
                 raise ValueError('Label "U" invalid in BIO mode')
             if current_start is not None:
-                raise ValueError(f"Invalid label at {i}: {label_action}")
+                raise ValueError(f"Invalid label at {i}: U")
             spans.append(TypedSpan(i, i + 1, label_type))
     if current_start is not None:
         if bilou:
@@ -115,82 +273,388 @@ def spans_from_labels(labels: Iterable[Tuple[str, Optional[str]]], bilou: bool):
     return spans
 
 
-def process_label(label: str, label_regex) -> Tuple[str, Optional[str]]:
-    label_match = re.match(label_regex, label)
+# Below this many labels, setting up the arrays costs more than the plain loop saves: the
+# NumPy version only breaks even at around 700 to 1000 labels, the Numba one at around 50
+VECTORIZED_MIN_LENGTH = 1000
+JIT_MIN_LENGTH = 64
+
+
+def spans_from_labels_vec(
+    actions: np.ndarray, types: np.ndarray, bilou: bool
+) -> Optional[List[TypedSpan]]:
+    """Extract a list of typed spans from `ACTION_CODES`-encoded actions and their types.
+
+    This gives the same spans as `spans_from_labels` for valid sequences and returns `None`
+    for anything else, in which case `spans_from_labels` should be used to get a precise error.
+    """
+    is_b = actions == ACTION_CODES["B"]
+    is_i = actions == ACTION_CODES["I"]
+    is_u = actions == ACTION_CODES["U"]
+    starts = np.flatnonzero(is_b)
+    if bilou:
+        is_l = actions == ACTION_CODES["L"]
+        # Whether we are in a segment right before each label
+        depth = np.cumsum(is_b, dtype=np.int64) - np.cumsum(is_l, dtype=np.int64)
+        inside = (depth - is_b + is_l) == 1
+        if (
+            np.any(actions > ACTION_CODES["U"])
+            or np.any(actions < 0)
+            or not np.array_equal(inside, is_i | is_l)
+            or (depth.size and depth[-1])
+        ):
+            return None
+        units = np.flatnonzero(is_u)
+        span_starts = np.concatenate((starts, units))
+        span_ends = np.concatenate((np.flatnonzero(is_l) + 1, units + 1))
+        continued = np.flatnonzero(inside)
+    else:
+        if np.any((actions != ACTION_CODES["O"]) & ~is_b & ~is_i):
+            return None
+        # An I must follow a B or an I, by induction it is then in a segment
+        previous = np.concatenate(([ACTION_CODES["O"]], actions[:-1]))
+        if np.any(
+            is_i & (previous != ACTION_CODES["B"]) & (previous != ACTION_CODES["I"])
+        ):
+            return None
+        breaks = np.append(np.flatnonzero(~is_i), actions.size)
+        span_starts = starts
+        span_ends = breaks[np.searchsorted(breaks, starts, side="right")]
+        continued = np.flatnonzero(is_i)
+    # Continuation labels have the type of the segment they are in
+    segment_starts = starts[np.cumsum(is_b)[continued] - 1]
+    if not np.all(types[continued] == types[segment_starts]):
+        return None
+    order = np.argsort(span_starts, kind="stable")
+    span_starts = span_starts[order]
+    return [
+        TypedSpan(start, end, label_type)
+        for start, end, label_type in zip(
+            span_starts.tolist(),
+            span_ends[order].tolist(),
+            types[span_starts].tolist(),
+        )
+    ]
+
+
+def _spans_from_labels_codes(
+    actions: np.ndarray, type_ids: np.ndarray, bilou: bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, bool]:
+    """Extract the starts, ends and type ids of the spans from `ACTION_CODES`-encoded actions
+    and int type ids.
+
+    This is the same state machine as `spans_from_labels`, written to be compiled by Numba. The
+    last element of the result is `False` if the sequence is invalid, use `spans_from_labels`
+    to get a precise error in that case.
+    """
+    n = actions.shape[0]
+    starts = np.empty(n, dtype=np.int32)
+    ends = np.empty(n, dtype=np.int32)
+    span_types = np.empty(n, dtype=np.int32)
+    n_spans = 0
+    current_start = -1
+    current_type = -1
+    for i in range(n):
+        label_action = actions[i]
+        label_type = type_ids[i]
+        # The codes are those of `ACTION_CODES`, ordered as in `spans_from_labels`
+        if label_action == 1:
+            if current_start < 0 or label_type != current_type:
+                return starts[:0], ends[:0], span_types[:0], False
+        elif label_action == 3:
+            if current_start >= 0:
+                if bilou:
+                    return starts[:0], ends[:0], span_types[:0], False
+                starts[n_spans] = current_start
+                ends[n_spans] = i
+                span_types[n_spans] = current_type
+                n_spans += 1
+                current_start = -1
+        elif label_action == 0:
+            if current_start >= 0:
+                if bilou:
+                    return starts[:0], ends[:0], span_types[:0], False
+                starts[n_spans] = current_start
+                ends[n_spans] = i
+                span_types[n_spans] = current_type
+                n_spans += 1
+            current_start = i
+            current_type = label_type
+        elif label_action == 2:
+            if not bilou or current_start < 0 or label_type != current_type:
+                return starts[:0], ends[:0], span_types[:0], False
+            starts[n_spans] = current_start
+            ends[n_spans] = i + 1
+            span_types[n_spans] = current_type
+            n_spans += 1
+            current_start = -1
+        elif label_action == 4:
+            if not bilou or current_start >= 0:
+                return starts[:0], ends[:0], span_types[:0], False
+            starts[n_spans] = i
+            ends[n_spans] = i + 1
+            span_types[n_spans] = label_type
+            n_spans += 1
+        else:
+            return starts[:0], ends[:0], span_types[:0], False
+    if current_start >= 0:
+        if bilou:
+            return starts[:0], ends[:0], span_types[:0], False
+        starts[n_spans] = current_start
+        ends[n_spans] = n
+        span_types[n_spans] = current_type
+        n_spans += 1
+    return starts[:n_spans], ends[:n_spans], span_types[:n_spans], True
+
+
+# Numba is optional, without it we fall back to `spans_from_labels_vec`
+if njit is not None:
+    _spans_from_labels_nb = njit(cache=True)(_spans_from_labels_codes)
+else:
+    _spans_from_labels_nb = None
+
+
+def _spans_from_labels_any(
+    actions: "array[int]", types: "array[int]", bilou: bool
+) -> List[TypedSpan]:
+    """Use the compiled or vectorized span extraction for long and valid sequences, the plain
+    one otherwise.
+
+    `actions` and `types` are `array('b')` and `array('i')`, which NumPy can view without
+    copying.
+    """
+    if _spans_from_labels_nb is not None and len(actions) >= JIT_MIN_LENGTH:
+        starts, ends, span_types, valid = _spans_from_labels_nb(
+            np.frombuffer(actions, dtype=np.int8),
+            np.frombuffer(types, dtype=np.intc),
+            bilou,
+        )
+        if valid:
+            return [
+                TypedSpan(start, end, label_type)
+                for start, end, label_type in zip(
+                    starts.tolist(), ends.tolist(), span_types.tolist()
+                )
+            ]
+    elif _spans_from_labels_nb is None and len(actions) >= VECTORIZED_MIN_LENGTH:
+        spans = spans_from_labels_vec(
+            np.frombuffer(actions, dtype=np.int8),
+            np.frombuffer(types, dtype=np.intc),
+            bilou=bilou,
+        )
+        if spans is not None:
+            return spans
+    return spans_from_labels(actions, types, bilou=bilou)
+
+
+# Keep in sync with the default of `--label-regex` in the usage string
+DEFAULT_LABEL_REGEX = r"(?P<type>.*)_(?P<action>[BILOU])"
+DEFAULT_LABEL_PATTERN = re.compile(DEFAULT_LABEL_REGEX)
+
+
+def process_label(
+    label: str, label_regex: Pattern[str], type_ids: Dict[Optional[str], int]
+) -> Tuple[int, int]:
+    action_group = label_regex.groupindex.get("action")
+    if action_group is None:
+        raise ValueError("Invalid label regex: missing group 'action'")
+    type_group = label_regex.groupindex.get("type")
+    label_match = label_regex.match(label)
     if not label_match:
         raise ValueError(f"Invalid label {label!r}")
-    groups = label_match.groupdict()
-    try:
-        return (groups["action"], groups.get("type"))
-    except KeyError as e:
-        raise ValueError(f"Invalid label regex: missing group {e.args[0]!r}")
+    label_action = ACTION_CODES.get(label_match.group(action_group))
+    if label_action is None:
+        raise ValueError(f"Invalid label action in {label!r}")
+    label_type = None if type_group is None else label_match.group(type_group)
+    return label_action, type_ids.setdefault(label_type, len(type_ids))
+
+
+def _process_label_fast(
+    label: str, label_regex: Pattern[str], type_ids: Dict[Optional[str], int]
+) -> Tuple[int, int]:
+    """Parse a `type_action` label with string operations.
+
+    Only valid when `label_regex` is `DEFAULT_LABEL_REGEX`, labels not in this canonical form
+    (e.g. with no separator at all) are left to the regex engine.
+    """
+    label_type, sep, label_action = label.rpartition("_")
+    if sep and len(label_action) == 1 and label_action in "BILOU":
+        return ACTION_CODES[label_action], type_ids.setdefault(
+            label_type, len(type_ids)
+        )
+    return process_label(label, label_regex, type_ids)
+
+
+def format_labels(
+    actions: Iterable[int], types: Iterable[int], type_ids: Dict[Optional[str], int]
+) -> str:
+    """Pretty-print a label sequence with the original label actions and types."""
+    type_names = list(type_ids)
+    return pprint.pformat(
+        [
+            (i, (ACTION_NAMES[label_action], type_names[label_type]))
+            for i, (label_action, label_type) in enumerate(zip(actions, types))
+        ]
+    )
 
 
 def process_block(
     block: Iterable[str],
-    label_regex: str,
+    label_regex: Pattern[str],
     gold_column: int,
     syst_column: int,
     bilou: bool,
     score: Callable[[TypedSpan, TypedSpan], float],
+    type_ids: Dict[Optional[str], int],
+    parsed_labels: Dict[str, Tuple[int, int]],
 ) -> Tuple[float, float, float]:
-    gold_labels = []
-    syst_labels = []
+    if label_regex.pattern == DEFAULT_LABEL_REGEX:
+        parse_label = _process_label_fast
+    else:
+        parse_label = process_label
+    # Only split the lines as far as needed to get both columns
+    if gold_column >= 0 and syst_column >= 0:
+        split, maxsplit = str.split, max(gold_column, syst_column) + 1
+    elif gold_column < 0 and syst_column < 0:
+        split, maxsplit = str.rsplit, max(-gold_column, -syst_column)
+    else:
+        split, maxsplit = str.split, -1
+    # Parallel arrays of action codes and type ids rather than lists of tuples
+    gold_actions, gold_types = array("b"), array("i")
+    syst_actions, syst_types = array("b"), array("i")
     for line in block:
-        columns = line.split()
+        columns = split(line, None, maxsplit)
+        gold_label = columns[gold_column]
+        syst_label = columns[syst_column]
+        # There are few distinct labels, so each of them is only parsed once per file
         try:
-            gold_labels.append(process_label(columns[gold_column], label_regex))
-            syst_labels.append(process_label(columns[syst_column], label_regex))
+            if gold_label not in parsed_labels:
+                parsed_labels[gold_label] = parse_label(
+                    gold_label, label_regex, type_ids
+                )
+            if syst_label not in parsed_labels:
+                parsed_labels[syst_label] = parse_label(
+                    syst_label, label_regex, type_ids
+                )
         except ValueError as e:
             raise ValueError(f"Invalid line {line!r}") from e
+        gold_action, gold_type = parsed_labels[gold_label]
+        gold_actions.append(gold_action)
+        gold_types.append(gold_type)
+        syst_action, syst_type = parsed_labels[syst_label]
+        syst_actions.append(syst_action)
+        syst_types.append(syst_type)
     try:
-        gold_spans = set(spans_from_labels(gold_labels, bilou=bilou))
+        gold_spans = _spans_from_labels_any(gold_actions, gold_types, bilou=bilou)
     except ValueError as e:
         raise ValueError(
-            f"Invalid gold label sequence:\n{pprint.pformat(list(enumerate(gold_labels)))}"
+            "Invalid gold label sequence:\n"
+            f"{format_labels(gold_actions, gold_types, type_ids)}"
         ) from e
     try:
-        syst_spans = set(spans_from_labels(syst_labels, bilou=bilou))
+        syst_spans = _spans_from_labels_any(syst_actions, syst_types, bilou=bilou)
     except ValueError as e:
         raise ValueError(
-            f"Invalid sys label sequence:\n{pprint.pformat(list(enumerate(syst_labels)))}"
+            "Invalid sys label sequence:\n"
+            f"{format_labels(syst_actions, syst_types, type_ids)}"
         ) from e
 
     return aligned_score(gold_spans, syst_spans, score)
 
 
+# Blocks are separated by blank lines, captured to keep track of line numbers
+BLOCK_SEPARATOR = re.compile(r"(\n\s*\n)")
+
+
+def iter_blocks(text: str) -> Iterator[Tuple[int, List[str]]]:
+    """Iterate on the blocks of a CoNLL text and the line numbers where they start."""
+    parts = BLOCK_SEPARATOR.split(text)
+    line_number = 1
+    for block, separator in zip(parts[::2], parts[1::2] + [""]):
+        content = block.lstrip()
+        if content:
+            block_start = line_number + block.count("\n", 0, len(block) - len(content))
+            yield block_start, content.rstrip().split("\n")
+        line_number += block.count("\n") + separator.count("\n")
+
+
+# The type ids and parsed labels of a worker process, shared by all the blocks it scores
+_worker_type_ids: Dict[Optional[str], int] = {}
+_worker_parsed_labels: Dict[str, Tuple[int, int]] = {}
+
+
+def _init_block_worker() -> None:
+    """Start a worker process with empty caches, even if it was forked from a process that
+    used them."""
+    _worker_type_ids.clear()
+    _worker_parsed_labels.clear()
+
+
+def _process_block_worker(
+    score_block: Callable[..., Tuple[float, float, float]], block: List[str]
+) -> Optional[Tuple[float, float, float]]:
+    """Score a block in a worker process, returning `None` if it is invalid.
+
+    Exception chains don't survive the trip back from the workers, so invalid blocks are
+    processed again in the main process to get a proper error.
+    """
+    try:
+        return score_block(
+            block, type_ids=_worker_type_ids, parsed_labels=_worker_parsed_labels
+        )
+    except ValueError:
+        return None
+
+
 def process_file(
-    lines: Iterable[str],
-    label_regex: str,
+    text: str,
+    label_regex: Pattern[str],
     gold_column: int,
     syst_column: int,
     bilou: bool,
     score: Callable[[TypedSpan, TypedSpan], float],
+    jobs: int = 1,
 ) -> Tuple[float, float, float]:
-    current_block: List[str] = []
+    score_block = functools.partial(
+        process_block,
+        label_regex=label_regex,
+        gold_column=gold_column,
+        syst_column=syst_column,
+        bilou=bilou,
+        score=score,
+    )
+    # Label types are interned once per file so that spans only carry small ints
+    type_ids: Dict[Optional[str], int] = {}
+    parsed_labels: Dict[str, Tuple[int, int]] = {}
     tru_pos, tru, pos = [], [], []
-    for i, l in enumerate(lines, start=1):
-        if not l:
-            try:
-                tp, t, p = process_block(
-                    current_block,
-                    label_regex=label_regex,
-                    gold_column=gold_column,
-                    syst_column=syst_column,
-                    bilou=bilou,
-                    score=score,
-                )
-            except ValueError as e:
-                raise ValueError(
-                    f"Invalid value in block starting at line {i-len(current_block)}"
-                ) from e
+    blocks = list(iter_blocks(text))
+    with contextlib.ExitStack() as stack:
+        results: Iterable[Optional[Tuple[float, float, float]]]
+        if jobs > 1:
+            pool = stack.enter_context(
+                multiprocessing.Pool(jobs, initializer=_init_block_worker)
+            )
+            results = pool.imap(
+                functools.partial(_process_block_worker, score_block),
+                (block for _, block in blocks),
+                chunksize=64,
+            )
+        else:
+            results = itertools.repeat(None)
+        for (block_start, block), result in zip(blocks, results):
+            if result is None:
+                try:
+                    result = score_block(
+                        block, type_ids=type_ids, parsed_labels=parsed_labels
+                    )
+                except ValueError as e:
+                    raise ValueError(
+                        f"Invalid value in block starting at line {block_start}"
+                    ) from e
+            tp, t, p = result
             tru_pos.append(tp)
             tru.append(t)
             pos.append(p)
-            current_block = []
-        else:
-            current_block.append(l)
-    return math.fsum(tru_pos), math.fsum(tru), math.fsum(pos)
+    return sum(tru_pos), sum(tru), sum(pos)
 
 
 def main_entry_point(argv=None):
@@ -200,14 +664,19 @@ def main_entry_point(argv=None):
         return
     if arguments["--score"] is None:
         arguments["--score"] = "strict"
+    if arguments["--label-regex"] == DEFAULT_LABEL_REGEX:
+        label_regex = DEFAULT_LABEL_PATTERN
+    else:
+        label_regex = re.compile(arguments["--label-regex"])
     with open(arguments["<file-name>"]) as in_stream:
         tru_pos, tru, pos = process_file(
-            (l.strip() for l in in_stream),
-            label_regex=arguments["--label-regex"],
+            in_stream.read(),
+            label_regex=label_regex,
             gold_column=int(arguments["--gold-column"]),
             syst_column=int(arguments["--sys-column"]),
             bilou=not arguments["--bio"],
             score=SCORES[arguments["--score"]],
+            jobs=int(arguments["--jobs"]),
         )
     p = tru_pos / pos
     r = tru_pos / tru